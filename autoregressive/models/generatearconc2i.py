@@ -1,12 +1,29 @@
 # Modified from:
 #   gpt-fast: https://github.com/pytorch-labs/gpt-fast/blob/main/generate.py
 #   DiT:      https://github.com/facebookresearch/DiT/blob/main/models.py
+import os
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
 import torch._dynamo.config
 import torch._inductor.config
 import copy
+import inspect
+try:
+    import flashinfer.sampling as flashinfer_sampling
+except ImportError:
+    flashinfer_sampling = None
+# sample() uses the flashinfer>=0.2 API: sampling_from_probs draws its own uniforms and the renorm kernels
+# are named *_renorm_probs; 0.1.x requires uniform_samples, so fall back to the PyTorch path there
+if flashinfer_sampling is not None and (
+    "uniform_samples" in inspect.signature(flashinfer_sampling.sampling_from_probs).parameters
+    or not hasattr(flashinfer_sampling, "top_k_renorm_probs")
+    or not hasattr(flashinfer_sampling, "top_p_renorm_probs")
+):
+    flashinfer_sampling = None
+
+_cfg_streams_cache = {}
+
 
 def top_k_top_p_filtering(
     logits,
@@ -26,13 +43,14 @@ def top_k_top_p_filtering(
     """
     if top_k > 0:
         top_k = min(max(top_k, min_tokens_to_keep), logits.size(-1))  # Safety check
-        # Remove all tokens with a probability less than the last token of the top-k
-        indices_to_remove = logits < torch.topk(logits, top_k)[0][..., -1, None]
-        logits[indices_to_remove] = filter_value
+        # Keep only the top-k logits; scattering them into a filled tensor avoids a full-vocab compare
+        topk_logits, topk_indices = torch.topk(logits, top_k)
+        logits = torch.full_like(logits, filter_value).scatter(-1, topk_indices, topk_logits)
 
     if top_p < 1.0:
         sorted_logits, sorted_indices = torch.sort(logits, descending=True)
-        cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
+        # plain scan: a matmul cumsum would run in TF32 under the scripts' matmul precision and move the cutoff
+        cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1, dtype=torch.float32), dim=-1)
 
         # Remove tokens with cumulative probability above the threshold (token with 0 are kept)
         sorted_indices_to_remove = cumulative_probs > top_p
@@ -45,37 +63,75 @@ def top_k_top_p_filtering(
 
         # scatter sorted tensors to original indexing
         indices_to_remove = sorted_indices_to_remove.scatter(1, sorted_indices, sorted_indices_to_remove)
-        logits[indices_to_remove] = filter_value
+        logits = logits.masked_fill(indices_to_remove, filter_value)
     return logits
 
 
-def sample(logits, temperature: float=1.0, top_k: int=0, top_p: float=1.0, sample_logits=True, index_mapping=None):        
-    logits = logits[:, -1, :] / max(temperature, 1e-5)
-    if top_k > 0 or top_p < 1.0:
-        logits = top_k_top_p_filtering(logits, top_k=top_k, top_p=top_p)
-    probs = F.softmax(logits, dim=-1)
-    if sample_logits:
-        idx = torch.multinomial(probs, num_samples=1)
-        token_confidence = torch.gather(probs, 1, idx)
+def build_pair_lut(index_mapping, vocab_size: int, device):
+    # pair_lut[red] = green and pair_lut[green] = red (the forward mapping wins on overlap); -1 marks unpaired codes
+    # built on the host and uploaded in one copy; the dict itself never reaches the per-step code
+    pair_lut = torch.full((vocab_size,), -1, dtype=torch.long)
+    if index_mapping:
+        keys = torch.tensor(list(index_mapping.keys()), dtype=torch.long)
+        values = torch.tensor(list(index_mapping.values()), dtype=torch.long)
+        pair_lut[values] = keys
+        pair_lut[keys] = values
+    return pair_lut.to(device)
+
+
+def sample(logits, temperature: float=1.0, top_k: int=0, top_p: float=1.0, sample_logits=True, pair_lut=None,
+           con_pairs_out=None, inv_temp=None):        
+    if logits.dim() == 3:
+        # the prefill / decode steps here ask the model for [B, V] last-position logits directly
+        logits = logits[:, -1, :]
+    if inv_temp is not None:
+        # 0-dim tensor from generate(): a new temperature does not specialize a compiled graph on a constant
+        logits = logits * inv_temp
     else:
-        token_confidence, idx = torch.topk(probs, k=1, dim=-1)
-    
-    paired_confidence = torch.zeros_like(token_confidence)
-    
-    if index_mapping is not None:
-        batch_size = idx.shape[0]
-        for b in range(batch_size):
-            selected_idx = idx[b, 0].item()
-            if selected_idx in index_mapping:
-                paired_idx = index_mapping[selected_idx]
-                paired_confidence[b, 0] = probs[b, paired_idx]
-            else:
-                for key, value in index_mapping.items():
-                    if value == selected_idx:
-                        paired_confidence[b, 0] = probs[b, key]
-                        break
-    
-    con_pairs = torch.cat([token_confidence.unsqueeze(-1), paired_confidence.unsqueeze(-1)], dim=-1)
+        logits = logits / max(temperature, 1e-5)
+    probs, log_z = None, None
+    if sample_logits and (top_k > 0 or top_p < 1.0) and flashinfer_sampling is not None and logits.is_cuda:
+        # FlashInfer filters and renormalizes without a vocab sort; the filtered probs are kept for the confidences
+        probs = F.softmax(logits, dim=-1, dtype=torch.float32)
+        if top_k > 0:
+            probs = flashinfer_sampling.top_k_renorm_probs(probs, top_k)
+        if top_p < 1.0:
+            probs = flashinfer_sampling.top_p_renorm_probs(probs, top_p)
+        idx = flashinfer_sampling.sampling_from_probs(probs).long().unsqueeze(-1)
+    else:
+        if top_k > 0 or top_p < 1.0:
+            logits = top_k_top_p_filtering(logits, top_k=top_k, top_p=top_p)
+        if sample_logits:
+            # Gumbel-max: argmax(logits + Gumbel noise) is an exact draw from softmax(logits), no multinomial needed
+            u = torch.rand_like(logits, dtype=torch.float32)
+            idx = (logits - torch.log(-torch.log(u.clamp_min(1e-20)))).argmax(dim=-1, keepdim=True)
+        else:
+            idx = logits.argmax(dim=-1, keepdim=True)
+        # probabilities are only needed at the sampled and paired indices, so normalize those with
+        # logsumexp instead of materializing a full-vocab softmax
+        log_z = torch.logsumexp(logits, dim=-1, keepdim=True)
+
+    def gather_probs(index, out=None):
+        if log_z is not None:
+            return torch.exp(logits.gather(1, index) - log_z, out=out)
+        return torch.gather(probs, 1, index, out=out)
+
+    # only the [B, 2] result reuses a buffer (con_pairs_out, preallocated by generate()); the vocab-sized
+    # temporaries above and the small gather indices below are still allocated on every call
+    if con_pairs_out is None:
+        con_pairs = torch.empty((idx.shape[0], 2), dtype=torch.float, device=idx.device)
+    else:
+        con_pairs = con_pairs_out[:, 0]
+    if pair_lut is not None:
+        # one gather for the sampled and the paired index; unpaired codes get a paired confidence of 0
+        paired_idx = pair_lut[idx]
+        gather_probs(torch.cat([idx, paired_idx.clamp_min(0)], dim=-1), out=con_pairs)
+        con_pairs[:, 1:] *= paired_idx.ge(0)
+    else:
+        # no pairs: the token confidence is written into column 0 and the paired column is zeroed in place
+        gather_probs(idx, out=con_pairs[:, :1])
+        con_pairs[:, 1:].zero_()
+    con_pairs = con_pairs.unsqueeze(1)
     
     return idx, con_pairs
 
@@ -88,113 +144,204 @@ def logits_to_probs(logits, temperature: float = 1.0, top_p: float=1.0, top_k: i
     return probs
 
 
-def prefill(model, cond_idx: torch.Tensor, input_pos: torch.Tensor, cfg_scale: float, index_mapping=None, **sampling_kwargs):
+def prefill(model, cond_idx: torch.Tensor, input_pos: torch.Tensor, cfg_scale: float, pair_lut=None, **sampling_kwargs):
     if cfg_scale > 1.0:
-        logits, _ = model(None, cond_idx, input_pos)
+        logits, _ = model(None, cond_idx, input_pos, return_last_logit=True)
         logits_combined = logits
         if logits_combined.shape[0] >= 2:
-            cond_logits, uncond_logits = torch.split(logits_combined, len(logits_combined) // 2, dim=0)
-            logits = uncond_logits + (cond_logits - uncond_logits) * cfg_scale
+            B = logits_combined.shape[0] // 2
+            logits = torch.lerp(logits_combined[B:], logits_combined[:B], cfg_scale) # uncond + (cond - uncond) * cfg_scale
         else:
             print("Warning: Not enough samples for CFG in prefill")
             logits = logits_combined
     else:
-        logits, _ = model(None, cond_idx, input_pos)
-    return sample(logits, index_mapping=index_mapping, **sampling_kwargs)
+        logits, _ = model(None, cond_idx, input_pos, return_last_logit=True)
+    return sample(logits, pair_lut=pair_lut, **sampling_kwargs)
+
+
+def decode_one_token_cfg(model, x_combined: torch.Tensor, input_pos: torch.Tensor, cfg_scale: float, pair_lut=None, **sampling_kwargs):
+    logits, _ = model(x_combined, cond_idx=None, input_pos=input_pos, return_last_logit=True)
+    B = logits.shape[0] // 2
+    logits = torch.lerp(logits[B:], logits[:B], cfg_scale) # uncond + (cond - uncond) * cfg_scale
+    return sample(logits, pair_lut=pair_lut, **sampling_kwargs)
+
+
+def decode_one_token_nocfg(model, x: torch.Tensor, input_pos: torch.Tensor, cfg_scale: float, pair_lut=None, **sampling_kwargs):
+    logits, _ = model(x, cond_idx=None, input_pos=input_pos, return_last_logit=True)
+    if cfg_scale > 1.0:
+        # past cfg_interval: x still carries the uncond half for the kv cache, only the cond logits are used
+        logits = logits[:logits.shape[0] // 2]
+    return sample(logits, pair_lut=pair_lut, **sampling_kwargs)
+
+
+def decode_one_token_cfg_parallel(model, x: torch.Tensor, input_pos: torch.Tensor, cfg_scale: float, cfg_streams, pair_lut=None, **sampling_kwargs):
+    # cond and uncond run as two batch-B forwards on their own streams, each on its half of the kv cache
+    stream_cond, stream_uncond = cfg_streams
+    B = x.shape[0]
+    current_stream = torch.cuda.current_stream(x.device)
+    stream_cond.wait_stream(current_stream)
+    stream_uncond.wait_stream(current_stream)
+    with torch.cuda.stream(stream_cond):
+        cond_logits, _ = model(x, cond_idx=None, input_pos=input_pos, kv_rows=slice(0, B), return_last_logit=True)
+    with torch.cuda.stream(stream_uncond):
+        uncond_logits, _ = model(x, cond_idx=None, input_pos=input_pos, kv_rows=slice(B, 2 * B), return_last_logit=True)
+    current_stream.wait_stream(stream_cond)
+    current_stream.wait_stream(stream_uncond)
+    cond_logits.record_stream(current_stream)
+    uncond_logits.record_stream(current_stream)
+    logits = torch.lerp(uncond_logits, cond_logits, cfg_scale)
+    return sample(logits, pair_lut=pair_lut, **sampling_kwargs)
+
+
+def get_cfg_streams(device):
+    if device not in _cfg_streams_cache:
+        _cfg_streams_cache[device] = (torch.cuda.Stream(device), torch.cuda.Stream(device))
+    return _cfg_streams_cache[device]
+
+
+# Compile the per-token step only; cfg_flag picks a variant in Python so it never becomes a graph guard
+COMPILE_DECODE = os.environ.get("INDEXMARK_COMPILE_DECODE", "0") == "1"
+if COMPILE_DECODE:
+    decode_one_token_cfg = torch.compile(decode_one_token_cfg, mode="reduce-overhead", fullgraph=True, dynamic=False)
+    decode_one_token_nocfg = torch.compile(decode_one_token_nocfg, mode="reduce-overhead", fullgraph=True, dynamic=False)
 
 
-def decode_one_token(model, x: torch.Tensor, input_pos: torch.Tensor, cfg_scale: float, cfg_flag: bool, index_mapping=None, **sampling_kwargs):
+def decode_one_token(model, x: torch.Tensor, input_pos: torch.Tensor, cfg_scale: float, cfg_flag: bool, x_scratch=None, cfg_streams=None, pair_lut=None, **sampling_kwargs):
     assert input_pos.shape[-1] == 1
+    if cfg_scale > 1.0 and cfg_flag and cfg_streams is not None:
+        return decode_one_token_cfg_parallel(model, x, input_pos, cfg_scale, cfg_streams, pair_lut=pair_lut, **sampling_kwargs)
     if cfg_scale > 1.0:
-        x_combined = torch.cat([x, x])
-        logits, _ = model(x_combined, cond_idx=None, input_pos=input_pos)
-        logits_combined = logits
-        if logits_combined.shape[0] >= 2:
-            cond_logits, uncond_logits = torch.split(logits_combined, len(logits_combined) // 2, dim=0) 
-            if cfg_flag:
-                logits = uncond_logits + (cond_logits - uncond_logits) * cfg_scale
-            else:
-                logits = cond_logits
+        # fill the preallocated [2B, 1] buffer outside the compiled step so its address stays stable for CUDA graphs
+        if x_scratch is None:
+            x = torch.cat([x, x])
         else:
-            print("Warning: Not enough samples for CFG in decode_one_token")
-            logits = logits_combined
-    else:
-        logits, _ = model(x, cond_idx=None, input_pos=input_pos)
-    return sample(logits, index_mapping=index_mapping, **sampling_kwargs)
+            B = x.shape[0]
+            x_scratch[:B].copy_(x)
+            x_scratch[B:].copy_(x)
+            x = x_scratch
+        if cfg_flag:
+            return decode_one_token_cfg(model, x, input_pos, cfg_scale, pair_lut=pair_lut, **sampling_kwargs)
+    return decode_one_token_nocfg(model, x, input_pos, cfg_scale, pair_lut=pair_lut, **sampling_kwargs)
 
 
 def decode_n_tokens(
     model, cur_token: torch.Tensor, input_pos: torch.Tensor, num_new_tokens: int, 
-    cfg_scale: float, cfg_interval: int, index_mapping=None,
-    **sampling_kwargs):
-    new_tokens, new_confidences = [], []
+    cfg_scale: float, cfg_interval: int, seq: torch.Tensor, confidences: torch.Tensor, T: int,
+    x_scratch=None, cfg_streams=None, pair_lut=None, **sampling_kwargs):
+    # tokens and confidences are written straight into the preallocated seq / confidences at T+1+i;
+    # input_pos is a 1-element buffer refilled in place so its identity stays fixed across steps
     cfg_flag = True
-    for i in range(num_new_tokens):
-        with torch.backends.cuda.sdp_kernel(enable_flash=False, enable_mem_efficient=False, enable_math=True): # Actually better for Inductor to codegen attention here
+    # the backend is selected once for the whole loop, not re-entered on every token
+    with torch.backends.cuda.sdp_kernel(enable_flash=False, enable_mem_efficient=False, enable_math=True): # Actually better for Inductor to codegen attention here
+        for i in range(num_new_tokens):
             if cfg_interval > -1 and i > cfg_interval:
                 cfg_flag = False
+            input_pos.fill_(T + i)
             next_token, token_confidence = decode_one_token(
-                model, cur_token, input_pos, cfg_scale, cfg_flag, index_mapping=index_mapping, **sampling_kwargs
+                model, cur_token, input_pos, cfg_scale, cfg_flag, x_scratch=x_scratch, cfg_streams=cfg_streams, pair_lut=pair_lut, **sampling_kwargs
             )
-            input_pos += 1
-            new_tokens.append(next_token.clone())
-            new_confidences.append(token_confidence.clone())
+            seq[:, T+1+i] = next_token.squeeze(-1)
+            confidences[:, T+1+i] = token_confidence.squeeze(1)
             cur_token = next_token.view(-1, 1)
-    
-    return new_tokens, new_confidences
+
+
+def setup_decode_buffers(max_batch_size: int, max_batch_size_cfg: int, device):
+    # kept on the model and reused across generate() calls, so the compiled decode steps
+    # see the same tensors (and CUDA graphs the same addresses) every time
+    buffers = {
+        "input_pos": torch.empty(1, dtype=torch.int, device=device),
+        "x_scratch": torch.empty((max_batch_size_cfg, 1), dtype=torch.int, device=device) if max_batch_size_cfg > max_batch_size else None,
+        "inv_temp": torch.ones((), dtype=torch.float, device=device),
+        "con_pairs_out": torch.empty((max_batch_size, 1, 2), dtype=torch.float, device=device),
+    }
+    if COMPILE_DECODE:
+        # static addresses let CUDA graphs read and write these buffers in place instead of copying them per replay
+        for buf in buffers.values():
+            if buf is not None:
+                torch._dynamo.mark_static_address(buf)
+    return buffers
 
 
 @torch.no_grad()
-def generate(model, cond, max_new_tokens, emb_masks=None, cfg_scale=1.0, cfg_interval=-1, confidence_threshold=0.8, index_mapping=None, **sampling_kwargs):
+def generate(model, cond, max_new_tokens, emb_masks=None, cfg_scale=1.0, **kwargs):
+    # model type is dispatched here once, so each entry point below prepares its own conditioning
     if model.model_type == 'c2i':
-        if cfg_scale > 1.0:
-            cond_null = torch.ones_like(cond) * model.num_classes
-            cond_combined = torch.cat([cond, cond_null])
-        else:
-            cond_combined = cond
-        T = 1
+        return generate_c2i(model, cond, max_new_tokens, emb_masks=emb_masks, cfg_scale=cfg_scale, **kwargs)
     elif model.model_type == 't2i':
-        if cfg_scale > 1.0:
-            cond_null = torch.zeros_like(cond) + model.cls_embedding.uncond_embedding
-            cond_combined = torch.cat([cond, cond_null])
-        else:
-            cond_combined = cond
-        T = cond.shape[1]      
+        return generate_t2i(model, cond, max_new_tokens, emb_masks=emb_masks, cfg_scale=cfg_scale, **kwargs)
     else:
         raise Exception("please check model type")
 
+
+@torch.no_grad()
+def generate_c2i(model, cond, max_new_tokens, emb_masks=None, cfg_scale=1.0, **kwargs):
+    if cfg_scale > 1.0:
+        cond_null = torch.ones_like(cond) * model.num_classes
+        cond_combined = torch.cat([cond, cond_null])
+    else:
+        cond_combined = cond
+    return generate_from_cond(model, cond_combined, 1, max_new_tokens, emb_masks=emb_masks, cfg_scale=cfg_scale, **kwargs)
+
+
+@torch.no_grad()
+def generate_t2i(model, cond, max_new_tokens, emb_masks=None, cfg_scale=1.0, **kwargs):
+    if cfg_scale > 1.0:
+        cond_null = torch.zeros_like(cond) + model.cls_embedding.uncond_embedding
+        cond_combined = torch.cat([cond, cond_null])
+    else:
+        cond_combined = cond
+    return generate_from_cond(model, cond_combined, cond.shape[1], max_new_tokens, emb_masks=emb_masks, cfg_scale=cfg_scale, **kwargs)
+
+
+@torch.no_grad()
+def generate_from_cond(model, cond_combined, T, max_new_tokens, emb_masks=None, cfg_scale=1.0, cfg_interval=-1, confidence_threshold=0.8, index_mapping=None, pair_lut=None, cfg_parallel=False, **sampling_kwargs):
+    # cond_combined already holds the [cond; uncond] stack when cfg_scale > 1; T is the condition token count
     T_new = T + max_new_tokens
     max_seq_length = T_new
-    max_batch_size = cond.shape[0]
+    max_batch_size = cond_combined.shape[0] // 2 if cfg_scale > 1.0 else cond_combined.shape[0]
 
-    device = cond.device
+    device = cond_combined.device
+    max_batch_size_cfg = max_batch_size * 2 if cfg_scale > 1.0 else max_batch_size
     with torch.device(device):
-        max_batch_size_cfg = max_batch_size * 2 if cfg_scale > 1.0 else max_batch_size
+        # reuses the existing kv caches when the shapes match, resetting only the causal mask
         model.setup_caches(max_batch_size=max_batch_size_cfg, max_seq_length=max_seq_length, dtype=model.tok_embeddings.weight.dtype)
     
     if emb_masks is not None:
         assert emb_masks.shape[0] == max_batch_size
         assert emb_masks.shape[-1] == T
         if cfg_scale > 1.0:
-            model.causal_mask[:, :, :T] = model.causal_mask[:, :, :T] * torch.cat([emb_masks, emb_masks]).unsqueeze(1)
-        else:
-            model.causal_mask[:, :, :T] = model.causal_mask[:, :, :T] * emb_masks.unsqueeze(1)
-
-        eye_matrix = torch.eye(model.causal_mask.size(1), model.causal_mask.size(2), device=device)
-        model.causal_mask[:] = model.causal_mask * (1 - eye_matrix) + eye_matrix
+            emb_masks = torch.cat([emb_masks, emb_masks])
+        # causal_mask is bool: mask the padded prompt columns in place, then re-enable every diagonal entry
+        model.causal_mask[:, :, :T].logical_and_(emb_masks.bool().unsqueeze(1))
+        model.causal_mask.diagonal(dim1=1, dim2=2).fill_(True)
     
+    # callers that generate repeatedly with the same mapping can pass a prebuilt pair_lut (see build_pair_lut)
+    if pair_lut is None and index_mapping is not None:
+        pair_lut = build_pair_lut(index_mapping, model.vocab_size, device)
+    elif pair_lut is not None:
+        pair_lut = pair_lut.to(device)
+    buffers_sig = (max_batch_size, max_batch_size_cfg, device)
+    if getattr(model, '_decode_buffers_sig', None) != buffers_sig:
+        model._decode_buffers = setup_decode_buffers(max_batch_size, max_batch_size_cfg, device)
+        model._decode_buffers_sig = buffers_sig
+    buffers = model._decode_buffers
+    # temperature is written into a persistent 0-dim fp32 tensor; multiplying keeps the result in the logits dtype
+    buffers["inv_temp"].fill_(1.0 / max(sampling_kwargs.pop("temperature", 1.0), 1e-5))
+    sampling_kwargs["inv_temp"] = buffers["inv_temp"]
+    # per-token output buffers for sample(), reused by prefill and every decode step
+    sampling_kwargs["con_pairs_out"] = buffers["con_pairs_out"]
+
     seq = torch.empty((max_batch_size, T_new), dtype=torch.int, device=device)
     confidences = torch.zeros((max_batch_size, T_new, 2), dtype=torch.float, device=device) 
 
     input_pos = torch.arange(0, T, device=device)
-    next_token, first_confidence = prefill(model, cond_combined, input_pos, cfg_scale, index_mapping=index_mapping, **sampling_kwargs)
+    next_token, first_confidence = prefill(model, cond_combined, input_pos, cfg_scale, pair_lut=pair_lut, **sampling_kwargs)
     seq[:, T:T+1] = next_token
     confidences[:, T:T+1] = first_confidence
 
-    input_pos = torch.tensor([T], device=device, dtype=torch.int)
-    generated_tokens, token_confidences = decode_n_tokens(model, next_token, input_pos, max_new_tokens-1, cfg_scale, cfg_interval, index_mapping=index_mapping, **sampling_kwargs)
-    seq[:, T+1:] = torch.cat(generated_tokens, dim=1)
-    
-    for i, conf in enumerate(token_confidences):
-        confidences[:, T+i+1] = conf.squeeze(1)
+    input_pos = buffers["input_pos"]
+    x_scratch = buffers["x_scratch"]
+    # opt-in: run the cond / uncond decode forwards on two CUDA streams instead of one 2B batch (eager only)
+    cfg_streams = get_cfg_streams(device) if cfg_parallel and cfg_scale > 1.0 and device.type == 'cuda' else None
+    decode_n_tokens(model, next_token, input_pos, max_new_tokens-1, cfg_scale, cfg_interval, seq, confidences, T, x_scratch=x_scratch, cfg_streams=cfg_streams, pair_lut=pair_lut, **sampling_kwargs)
     return seq[:, T:], confidences[:, T:]
@@ -174,11 +174,11 @@ class KVCache(nn.Module):
         self.register_buffer('k_cache', torch.zeros(cache_shape, dtype=dtype))
         self.register_buffer('v_cache', torch.zeros(cache_shape, dtype=dtype))
 
-    def update(self, input_pos, k_val, v_val):
-        # input_pos: [S], k_val: [B, H, S, D]
+    def update(self, input_pos, k_val, v_val, kv_rows: Optional[slice] = None):
+        # input_pos: [S], k_val: [B, H, S, D]; kv_rows selects a batch slice of the cache (e.g. one CFG half)
         assert input_pos.shape[0] == k_val.shape[2]
-        k_out = self.k_cache
-        v_out = self.v_cache
+        k_out = self.k_cache if kv_rows is None else self.k_cache[kv_rows]
+        v_out = self.v_cache if kv_rows is None else self.v_cache[kv_rows]
         k_out[:, :, input_pos] = k_val
         v_out[:, :, input_pos] = v_val
 
@@ -207,7 +207,8 @@ class Attention(nn.Module):
     def forward(
         self, x: torch.Tensor, freqs_cis: torch.Tensor = None, 
         input_pos: Optional[torch.Tensor] = None, 
-        mask: Optional[torch.Tensor] = None
+        mask: Optional[torch.Tensor] = None,
+        kv_rows: Optional[slice] = None,
     ):
         bsz, seqlen, _ = x.shape
         kv_size = self.n_kv_head * self.head_dim
@@ -223,7 +224,7 @@ class Attention(nn.Module):
         xq, xk, xv = map(lambda x: x.transpose(1, 2), (xq, xk, xv))
 
         if self.kv_cache is not None:
-            keys, values = self.kv_cache.update(input_pos, xk, xv)
+            keys, values = self.kv_cache.update(input_pos, xk, xv, kv_rows)
         else:
             keys, values = xk, xv
         keys = keys.repeat_interleave(self.n_head // self.n_kv_head, dim=1)
@@ -251,8 +252,9 @@ class TransformerBlock(nn.Module):
         self.drop_path = DropPath(drop_path) if drop_path > 0. else nn.Identity()
 
     def forward(
-        self, x: torch.Tensor, freqs_cis: torch.Tensor, start_pos: int, mask: Optional[torch.Tensor] = None):
-        h = x + self.drop_path(self.attention(self.attention_norm(x), freqs_cis, start_pos, mask))
+        self, x: torch.Tensor, freqs_cis: torch.Tensor, start_pos: int, mask: Optional[torch.Tensor] = None,
+        kv_rows: Optional[slice] = None):
+        h = x + self.drop_path(self.attention(self.attention_norm(x), freqs_cis, start_pos, mask, kv_rows))
         out = h + self.drop_path(self.feed_forward(self.ffn_norm(h)))
         return out
 
@@ -314,10 +316,15 @@ class Transformer(nn.Module):
             module.weight.data.normal_(mean=0.0, std=std)
 
     def setup_caches(self, max_batch_size, max_seq_length, dtype):
-        # if self.max_seq_length >= max_seq_length and self.max_batch_size >= max_batch_size:
-        #     return
         head_dim = self.config.dim // self.config.n_head
         max_seq_length = find_multiple(max_seq_length, 8)
+        kv_cache = self.layers[0].attention.kv_cache
+        if (self.max_seq_length == max_seq_length and self.max_batch_size == max_batch_size and kv_cache is not None
+                and kv_cache.k_cache.dtype == dtype and kv_cache.k_cache.device == torch.empty(0).device):
+            # same shapes as the current caches: keep them (every position is rewritten before it is attended to)
+            # and only restore the causal mask, which callers edit in place for prompt padding
+            self.causal_mask.fill_(True).tril_()
+            return
         self.max_seq_length = max_seq_length
         self.max_batch_size = max_batch_size
         for b in self.layers:
@@ -337,6 +344,8 @@ class Transformer(nn.Module):
         targets: Optional[torch.Tensor] = None,
         mask: Optional[torch.Tensor] = None,
         valid: Optional[torch.Tensor] = None,
+        kv_rows: Optional[slice] = None, # batch slice of the kv cache / causal mask used in cached inference
+        return_last_logit: bool = False, # only project the last position, logits come back as [B, V]
     ):
         if idx is not None and cond_idx is not None: # training or naive inference
             cond_embeddings = self.cls_embedding(cond_idx, train=self.training)[:,:self.cls_token_num]
@@ -351,7 +360,7 @@ class Transformer(nn.Module):
                 token_embeddings = self.tok_embeddings(idx)
             
             bs = token_embeddings.shape[0]
-            mask = self.causal_mask[:bs, None, input_pos]
+            mask = self.causal_mask[slice(None, bs) if kv_rows is None else kv_rows, None, input_pos]
             h = self.tok_dropout(token_embeddings)
             self.freqs_cis = self.freqs_cis
         
@@ -361,9 +370,11 @@ class Transformer(nn.Module):
             freqs_cis = self.freqs_cis[input_pos]
         # transformer blocks
         for layer in self.layers:
-            h = layer(h, freqs_cis, input_pos, mask)
+            h = layer(h, freqs_cis, input_pos, mask, kv_rows)
         
         # output layers
+        if return_last_logit:
+            h = h[:, -1]
         h = self.norm(h)
         logits = self.output(h).float()
         
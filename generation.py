@@ -16,7 +16,7 @@ from torchvision.utils import save_image
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(current_dir)
-from autoregressive.models.generatearcon import generate
+from autoregressive.models.generatearcon import generate, build_pair_lut
 from autoregressive.models.gpt import GPT_models
 from language.t5 import T5Embedder
 from tokenizer.tokenizer_image.vq_model import VQ_models
@@ -502,6 +502,11 @@ def main(args, hc, vq_model, start_index, filename, prompts=None):
     os.makedirs(save_base_dir, exist_ok=True)
     print(f"Saving images to base directory: {save_base_dir}")
 
+    # Build the red/green pair lookup on the device once instead of on every generate() call
+    pair_lut = None
+    if hasattr(hc, 'index_mapping') and hc.index_mapping is not None:
+        pair_lut = build_pair_lut(hc.index_mapping, gpt_model.vocab_size, device)
+
     total_start_time = time.time()
 
     for prompt_idx, prompt in enumerate(prompts):
@@ -544,7 +549,8 @@ def main(args, hc, vq_model, start_index, filename, prompts=None):
             cfg_scale=args.cfg_scale,
             temperature=args.temperature, top_k=args.top_k,
             top_p=args.top_p, sample_logits=True,
-            index_mapping = index_map_to_pass # Pass the mapping or None
+            index_mapping = index_map_to_pass, # Pass the mapping or None
+            pair_lut = pair_lut
         )
         sampling_time = time.time() - t1
         print(f"  GPT sampling took {sampling_time:.2f} seconds.")
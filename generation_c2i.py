@@ -14,7 +14,7 @@ from sklearn.metrics.pairwise import cosine_similarity
 from torchvision.utils import save_image
 from tokenizer.tokenizer_image.vq_model import VQ_models
 from autoregressive.models.gpt import GPT_models
-from autoregressive.models.generatearconc2i import generate 
+from autoregressive.models.generatearconc2i import generate, build_pair_lut
 
 torch.backends.cuda.matmul.allow_tf32 = True
 torch.backends.cudnn.allow_tf32 = True
@@ -475,6 +475,11 @@ def main(args, hc, vq_model_main, gpt_model):
     print(f"Generating {num_seeds_per_class} samples for each of {total_classes} classes.")
     print(f"Processing in batches of size {batch_size}.")
 
+    # Build the red/green pair lookup on the device once instead of on every generate() call
+    pair_lut = None
+    if hc and hasattr(hc, 'index_mapping') and hc.index_mapping is not None:
+        pair_lut = build_pair_lut(hc.index_mapping, gpt_model.vocab_size, device)
+
     total_images_generated = 0
     overall_start_time = time.time()
 
@@ -507,7 +512,8 @@ def main(args, hc, vq_model_main, gpt_model):
                     top_k=args.top_k,
                     top_p=args.top_p,
                     sample_logits=True,
-                    index_mapping=hc.index_mapping if hc and hasattr(hc, 'index_mapping') else None # Pass HC mapping
+                    index_mapping=hc.index_mapping if hc and hasattr(hc, 'index_mapping') else None, # Pass HC mapping
+                    pair_lut=pair_lut
             )
             sampling_time = time.time() - t1
 